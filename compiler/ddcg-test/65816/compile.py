@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 
+import io
+import re
 import sys
+from functools import lru_cache
 
 import attr
 
@@ -27,6 +30,7 @@ CD_RET = 0
 CD_NEXT = 1
 CD_LABEL = 100
 
+@lru_cache(maxsize=1024)
 def starts_with_decimal_digit(t):
     return '0' <= t[0] <= '9'
 
@@ -45,28 +49,41 @@ def is_pair(node):
     return isinstance(node, Pair)
 
 
+def node_args(node, n):
+    # Returns the first n arguments of the form (OP ARG1 ARG2 ...).
+    args = []
+    p = node.cdr
+    for _ in range(n):
+        args.append(p.car)
+        p = p.cdr
+    return args
+
+
+# Numeric literals: 0x hex, 0o octal, 0b binary, leading-zero octal, and
+# decimal.  Each alternative captures its digits in one group; the group
+# number selects the base from _NUMBER_BASES.
+_NUMBER = re.compile(r'0[xX]([0-9a-fA-F]+)|0[oO]([0-7]+)|0[bB]([01]+)|(0[0-7]*)|([1-9][0-9]*)')
+_NUMBER_BASES = (None, 16, 8, 2, 8, 10)
+
+
+@lru_cache(maxsize=1024)
 def to_number(t):
-    if len(t) >= 1:
-        if t[0] == '0':
-            if len(t) >= 3:
-                if t[1] in ['x', 'X']:
-                    return int(t[2:], 16)
-                elif t[1] in ['o', 'O']:
-                    return int(t[2:], 8)
-                elif t[1] in ['b', 'B']:
-                    return int(t[2:], 2)
-            return int(t, 8)
-        elif '1' <= t[0] <= '9':
-            return int(t, 10)
-    else:
+    if len(t) < 1:
         raise ValueError("to_number called with empty token")
+    m = _NUMBER.fullmatch(t)
+    if m is None:
+        raise ValueError(f"Malformed number: {t}")
+    return int(m[m.lastindex], _NUMBER_BASES[m.lastindex])
 
 
 class Compiler:
+    __slots__ = ('parser_config', 'assembly_listing', '_emit', 'globals', 'next_label', 'zpptr')
+
     def __init__(self):
         self.parser_config = ParserConfig({}, dots_are_cons=True)
         self.assembly_listing = None
-        self.globals = list()
+        self._emit = None
+        self.globals = dict()
         self.next_label = CD_LABEL - 1
         self.zpptr = 0
 
@@ -82,13 +99,13 @@ class Compiler:
         return self.next_label
 
     def main(self, script=None):
-        self.assembly_listing = []
+        self.assembly_listing = io.StringIO()
+        self._emit = self.assembly_listing.write
 
         tree = parse(script, self.parser_config)
         for node in tree:
             self.cg_form(node, DD_AC, CD_RET)
-        for line in self.assembly_listing:
-            print(line)
+        sys.stdout.write(self.assembly_listing.getvalue())
 
     def cg_form(self, node, dd, cd):
 #       if dd == DD_ZFLAG:
@@ -105,59 +122,20 @@ class Compiler:
             self.cg_goto(cd)
         elif dd == DD_ZP:
             self.cg_form(node, DD_AC, CD_NEXT)
-            self.asm(None, "STA", "${:02X}".format(self.zpptr - 2))
+            self.asm(None, "STA", f"${self.zpptr - 2:02X}")
             self.cg_goto(cd)
         elif is_pair(node):
-            if node.car == '+':
-                self.cg_binop(self.cg_add, node, dd, cd)
-            elif node.car == '-':
-                self.cg_binop(self.cg_subtract, node, dd, cd)
-            elif node.car == '*':
-                self.cg_binop(self.cg_multiply, node, dd, cd)
-            elif node.car == '/':
-                self.cg_binop(self.cg_divide, node, dd, cd)
-            elif node.car == '&':
-                self.cg_binop(self.cg_bit_and, node, dd, cd)
-            elif node.car == '|':
-                self.cg_binop(self.cg_bit_or, node, dd, cd)
-            elif node.car == '^':
-                self.cg_binop(self.cg_bit_xor, node, dd, cd)
-            elif node.car == 'int16':
-                self.declare_variables(node)
-            elif node.car == 'set':
-                self.cg_set_var(node, dd, cd)
-            elif node.car == 'if':
-                self.cg_if(node, dd, cd)
-            elif node.car == 'sub':
-                self.cg_sub(node, dd, CD_RET)
-            elif node.car == 'do':
-                self.cg_statements(node.cdr, dd, CD_RET)
-            elif node.car == '@':
-                self.cg_address_of(node, dd, cd)
-            elif node.car == 'poke':
-                self.cg_poke(node, dd, cd)
-            elif node.car == 'peek':
-                self.cg_peek(node, dd, cd)
-            elif node.car == 'output': # Intel/Z80 specific
-                self.cg_poke(node, dd, cd)
-            elif node.car == 'input': # Intel/Z80 specific
-                self.cg_peek(node, dd, cd)
-            elif node.car == 'highbyte':
-                self.cg_highbyte(node, dd, cd)
-            elif node.car == 'lowbyte':
-                self.cg_lowbyte(node, dd, cd)
-            elif node.car == '>>':
-                self.cg_shift_right_logical(node, dd, cd)
-            elif node.car == '<<':
-                self.cg_shift_left(node, dd, cd)
+            if not isinstance(node.car, str):
+                raise ValueError(f"Unsupported: {node.car}")
+            handler = self._FORM_DISPATCH.get(node.car)
+            if handler is not None:
+                handler(self, node, dd, cd)
+            elif node.car not in self.globals:
+                raise ValueError(f"Unsupported: {node.car}")
+            elif node.cdr is not nil:
+                raise ValueError(f"Arguments to subroutines not supported: {node.car}")
             else:
-                if node.car not in self.globals:
-                    raise ValueError("Unsupported: {}".format(node.car))
-                else:
-                    if node.cdr is not nil:
-                        raise ValueError("Arguments to subroutines not supported: {}".format(node.car))
-                    else:
-                        self.cg_call_libfn(node.car, cd)
+                self.cg_call_libfn(node.car, cd)
         else:
             if starts_with_decimal_digit(node):
                 n = to_number(node)
@@ -166,7 +144,7 @@ class Compiler:
                     self.cg_ld16(dd, n)
                     self.cg_goto(cd)
                 else:
-                    raise ValueError("Unknown data destination: {}".format(dd))
+                    raise ValueError(f"Unknown data destination: {dd}")
             elif node[0] == '-':
                 n = -to_number(node[1:])
 
@@ -174,13 +152,13 @@ class Compiler:
                     self.cg_ld16(dd, n)
                     self.cg_goto(cd)
                 else:
-                    raise ValueError("Unknown data destination: {}".format(dd))
+                    raise ValueError(f"Unknown data destination: {dd}")
             else:
                 if node in self.globals:
                     self.cg_ld16_gv(dd, node)
                     self.cg_goto(cd)
                 else:
-                    raise ValueError("Symbol not declared: {}".format(node))
+                    raise ValueError(f"Symbol not declared: {node}")
 
     def cg_bit_or(self, dd, ds1, ds2, cd):
         self._cg_bit_op("ORA", dd, ds1, ds2, cd)
@@ -224,9 +202,9 @@ class Compiler:
             else:
                 self.asm(None, op, "1,S")
         elif ds2 == DD_ZP:
-            self.asm(None, op, "${:02X}".format(self.zpptr - 2))
+            self.asm(None, op, f"${self.zpptr - 2:02X}")
         else:
-            raise ValueError("ds2 Unrecognized destination {}".format(ds2))
+            raise ValueError(f"ds2 Unrecognized destination {ds2}")
 
         if dd == DD_AC:
             pass
@@ -242,15 +220,14 @@ class Compiler:
             else:
                 pass
         elif dd == DD_ZP:
-            self.asm(None, "STA", "${:02}".format(self.zpptr - 2))
+            self.asm(None, "STA", f"${self.zpptr - 2:02}")
 
 
         self.cg_goto(cd)
 
     def cg_shift_right_logical(self, node, dd, cd):
         # (>> EXPR COUNT)
-        e = node.cdr.car
-        cnt = node.cdr.cdr.car
+        e, cnt = node_args(node, 2)
         
         n_cnt = None
         if starts_with_decimal_digit(cnt):
@@ -264,10 +241,10 @@ class Compiler:
             if n_cnt is None:
                 skipahead = self.make_label()
                 self.asm(None, "CPX", "#0")
-                self.asm(None, "BEQ", "L{}".format(skipahead))
+                self.asm(None, "BEQ", f"L{skipahead}")
             self.asm(loopback, "LSR", "A")
             self.asm(None, "DEX", None)
-            self.asm(None, "BNE", "L{}".format(loopback))
+            self.asm(None, "BNE", f"L{loopback}")
             if n_cnt is None:
                 self.cg_emit_label(skipahead)
 
@@ -298,11 +275,10 @@ class Compiler:
 
     def cg_peek(self, node, dd, cd):
         # (peek SIZE ADDR)
-        sz = node.cdr.car
-        addr = node.cdr.cdr.car
+        sz, addr = node_args(node, 2)
 
         if dd != DD_AC:
-            raise ValueError("Unknown destination {}".format(dd))
+            raise ValueError(f"Unknown destination {dd}")
 
         if sz == 'byte':
             self.cg_form(addr, DD_XR, CD_NEXT)
@@ -312,15 +288,13 @@ class Compiler:
             self.cg_form(addr, DD_XR, CD_NEXT)
             self.asm(None, "LDA", "0,X")
         else:
-            raise ValueError("Unsupported poke size: {}".format(sz))
+            raise ValueError(f"Unsupported poke size: {sz}")
 
         self.cg_goto(cd)
 
     def cg_poke(self, node, dd, cd):
         # (poke SIZE ADDR DATUM)
-        sz = node.cdr.car
-        addr = node.cdr.cdr.car
-        datum = node.cdr.cdr.cdr.car
+        sz, addr, datum = node_args(node, 3)
 
         if sz == 'byte':
             self.cg_form(addr, DD_XR, CD_NEXT)
@@ -335,7 +309,7 @@ class Compiler:
             self.asm(None, "STA", "0,X")
             self.cg_goto(cd)
         else:
-            raise ValueError("Unsupported poke size: {}".format(sz))
+            raise ValueError(f"Unsupported poke size: {sz}")
 
     def cg_address_of(self, node, dd, cd):
         # (@ VAR)
@@ -343,7 +317,7 @@ class Compiler:
         if v is nil:
             raise ValueError("@ operator missing variable or procedure name")
         elif v.car not in self.globals:
-            raise ValueError("@ operator reference to undeclared variable or procedure: {}".format(v.car))
+            raise ValueError(f"@ operator reference to undeclared variable or procedure: {v.car}")
         else:
             self.cg_ld16(dd, v.car)
             self.cg_goto(cd)
@@ -368,8 +342,8 @@ class Compiler:
         name = node.cdr.car
         statements = node.cdr.cdr
         if name in self.globals:
-            raise ValueError("Symbol already defined: {}".format(name))
-        self.globals.append(name)
+            raise ValueError(f"Symbol already defined: {name}")
+        self.globals[name] = None
         self.cg_emit_label(name)
         self.cg_statements(statements, dd, cd)
 
@@ -378,8 +352,7 @@ class Compiler:
         label_false = self.make_label()
         label_end = self.make_label()
 
-        pred = node.cdr.car
-        conseq = node.cdr.cdr.car
+        pred, conseq = node_args(node, 2)
         alter = None
         if node.cdr.cdr.cdr is not nil:
             alter = node.cdr.cdr.cdr.car
@@ -393,51 +366,59 @@ class Compiler:
             else:
                 self.cg_form(pred, DD_ZFLAG, (CD_NEXT, cd))
                 self.cg_form(conseq, DD_AC, cd)
-        else:
+        elif (cd == CD_NEXT) or isinstance(cd, tuple):
             self.cg_form(pred, DD_ZFLAG, (CD_NEXT, label_false))
             self.cg_form(conseq, DD_AC, label_end)
             self.cg_emit_label(label_false)
             self.cg_form(alter, DD_AC, CD_NEXT)
             self.cg_emit_label(label_end)
             self.cg_goto(cd)
+        else:
+            # Both arms go straight to cd, so neither jumps to a return or
+            # to another jump.
+            self.cg_form(pred, DD_ZFLAG, (CD_NEXT, label_false))
+            self.cg_form(conseq, DD_AC, cd)
+            self.cg_emit_label(label_false)
+            self.cg_form(alter, DD_AC, cd)
 
     def declare_variables(self, node):
         varlist = node.cdr
         while varlist is not nil:
             if varlist.car in self.globals:
-                raise ValueError("Variable already defined: {}".format(varlist.car))
-            self.globals.append(varlist.car)
+                raise ValueError(f"Variable already defined: {varlist.car}")
+            self.globals[varlist.car] = None
             self.asm(varlist.car, ".WORD", "0")
             varlist = varlist.cdr
 
     def cg_set_var(self, node, dd, cd):
         # (set VAR EXPR_hl)
-        v = node.cdr.car
-        e = node.cdr.cdr.car
+        v, e = node_args(node, 2)
 
         if dd != DD_AC:
-            raise ValueError("Unknown destination {}".format(dd))
+            raise ValueError(f"Unknown destination {dd}")
 
         self.cg_form(e, DD_AC, CD_NEXT)
-        self.asm(None, "STA", "{}".format(v))
+        self.asm(None, "STA", v)
         self.cg_goto(cd)
 
-    def cg_binop(self, op, node, dd, cd):
+    def cg_binop(self, node, dd, cd):
+        op = self._BINOPS[node.car]
+        lhs, rhs = node_args(node, 2)
         self.alloc_zp()
-        self.cg_form(node.cdr.cdr.car, DD_ZP, CD_NEXT)
-        self.cg_form(node.cdr.car, DD_AC, CD_NEXT)
-        op(dd, DD_AC, DD_ZP, cd)
+        self.cg_form(rhs, DD_ZP, CD_NEXT)
+        self.cg_form(lhs, DD_AC, CD_NEXT)
+        op(self, dd, DD_AC, DD_ZP, cd)
         self.free_zp()
 
     def cg_ld16(self, dd, v):
         if dd == DD_AC:
-            self.asm(None, "LDA", "#{}".format(v))
+            self.asm(None, "LDA", f"#{v}")
         elif dd == DD_XR:
-            self.asm(None, "LDX", "#{}".format(v))
+            self.asm(None, "LDX", f"#{v}")
         elif dd == DD_YR:
-            self.asm(None, "LDY", "#{}".format(v))
+            self.asm(None, "LDY", f"#{v}")
         else:
-            raise ValueError("Unknown destination {}".format(dd))
+            raise ValueError(f"Unknown destination {dd}")
 
     def cg_ld16_gv(self, dd, t):
         if dd == DD_AC:
@@ -447,7 +428,7 @@ class Compiler:
         elif dd == DD_YR:
             self.asm(None, "LDY", t)
         else:
-            raise ValueError("Unknown destination {}".format(dd))
+            raise ValueError(f"Unknown destination {dd}")
 
     def cg_call_libfn(self, fn_name, cd):
         if cd != CD_RET:
@@ -457,6 +438,8 @@ class Compiler:
             self.asm(None, "JMP", fn_name)
 
     def cg_goto(self, cd):
+        if cd == CD_NEXT:
+            return
         if isinstance(cd, tuple):
             true_branch = cd[0]
             false_branch = cd[1]
@@ -468,48 +451,76 @@ class Compiler:
                     self.asm(None, "BNE", "*+3")
                     self.asm(None, "RTS", None)
                 else:
-                    self.asm(None, "BEQ", "L{}".format(false_branch))
+                    self.asm(None, "BEQ", f"L{false_branch}")
             elif true_branch == CD_RET:
                 if false_branch == CD_NEXT:
                     skippoint = self.make_label()
-                    self.asm(None, "BEQ", "L{}".format(skippoint))
+                    self.asm(None, "BEQ", f"L{skippoint}")
                     self.asm(None, "RTS", None)
                     self.cg_emit_label(skippoint)
                 elif false_branch == CD_RET:
                     return self.cg_goto(CD_RET)
                 else:
                     skippoint = self.make_label()
-                    self.asm(None, "BEQ", "L{}".format(skippoint))
+                    self.asm(None, "BEQ", f"L{skippoint}")
                     self.cg_goto(false_branch)
                     self.cg_emit_label(skippoint)
 
-        elif cd == CD_NEXT:
-            pass
         elif cd == CD_RET:
             self.asm(None, "RET", None)
         elif cd >= CD_LABEL:
-            self.asm(None, "JMP", "L{}".format(cd))
+            self.asm(None, "JMP", f"L{cd}")
         else:
-            raise ValueError("Unknown control destination: {}".format(cd))
+            raise ValueError(f"Unknown control destination: {cd}")
 
     def cg_emit_label(self, l):
         if l is not None:
             if isinstance(l, int):
-                l = "L{}".format(l)
-            self.assembly_listing.append("{}:".format(l))
+                l = f"L{l}"
+            self._emit(f"{l}:\n")
 
     def asm(self, label, mnem, oper):
-        self.cg_emit_label(label)
+        if label is not None:
+            self.cg_emit_label(label)
         if oper is None:
             oper = ""
-        self.assembly_listing.append("    {:6} {}".format(mnem, oper))
-
-    def to_reg(self, dd):
-        return {
-            DD_AC: 'A',
-            DD_XR: 'X',
-            DD_YR: 'Y',
-        }[dd]
+        self._emit(f"    {mnem:<6} {oper}\n")
+
+
+# Special forms recognized by cg_form, keyed by the symbol in operator
+# position.  Anything not listed here is treated as a subroutine call.
+Compiler._FORM_DISPATCH = {
+    '+':        Compiler.cg_binop,
+    '-':        Compiler.cg_binop,
+    '&':        Compiler.cg_binop,
+    '|':        Compiler.cg_binop,
+    '^':        Compiler.cg_binop,
+    'int16':    lambda self, node, dd, cd: self.declare_variables(node),
+    'set':      Compiler.cg_set_var,
+    'if':       Compiler.cg_if,
+    'sub':      lambda self, node, dd, cd: self.cg_sub(node, dd, CD_RET),
+    'do':       lambda self, node, dd, cd: self.cg_statements(node.cdr, dd, CD_RET),
+    '@':        Compiler.cg_address_of,
+    'poke':     Compiler.cg_poke,
+    'peek':     Compiler.cg_peek,
+    'output':   Compiler.cg_poke,  # Intel/Z80 specific
+    'input':    Compiler.cg_peek,  # Intel/Z80 specific
+    'highbyte': Compiler.cg_highbyte,
+    'lowbyte':  Compiler.cg_lowbyte,
+    '>>':       Compiler.cg_shift_right_logical,
+    '<<':       Compiler.cg_shift_left,
+}
+
+# Binary operators handled by cg_binop, keyed by symbol.  Each emitter
+# takes (dd, ds1, ds2, cd) once both operands are in place.  There is no
+# multiply or divide on this target yet.
+Compiler._BINOPS = {
+    '+': Compiler.cg_add,
+    '-': Compiler.cg_subtract,
+    '&': Compiler.cg_bit_and,
+    '|': Compiler.cg_bit_or,
+    '^': Compiler.cg_bit_xor,
+}
 
 
 if __name__ == '__main__':
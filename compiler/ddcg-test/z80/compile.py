@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 
+import io
+import re
 import sys
+from functools import lru_cache
 
 import attr
 
@@ -22,6 +25,44 @@ DD_TMP = 4
 DD_ZFLAG = 5
 DD_B = 6
 
+# Register names for each register data destination, plus the high and
+# low halves of each register pair.
+_REG = {
+    DD_A:  'A',
+    DD_B:  'B',
+    DD_BC: 'BC',
+    DD_DE: 'DE',
+    DD_HL: 'HL',
+}
+_REG_HI = {
+    DD_BC: 'B',
+    DD_DE: 'D',
+    DD_HL: 'H',
+}
+_REG_LO = {
+    DD_BC: 'C',
+    DD_DE: 'E',
+    DD_HL: 'L',
+}
+_REG8 = {'A', 'B', 'C', 'D', 'E', 'H', 'L'}
+_REG16 = {'BC', 'DE', 'HL', 'SP'}
+
+# Shifts of HL handled by cg_shift, keyed by symbol, as (step,
+# max_unrolled, to_r8, from_r8, byte_step).  step shifts by one bit.  A
+# count of 8 or more first moves from_r8 into to_r8 and clears from_r8,
+# then finishes with byte_step.
+_SHIFTS = {
+    '<<': ([("ADD", "HL,HL")], 8, "H", "L", [("ADD", "HL,HL")]),
+    '>>': ([("SRL", "H"), ("RR", "L")], 4, "L", "H", [("SRL", "L")]),
+}
+
+# 8-bit ALU operations that only change A when written as "OP A,r".
+_ALU8 = {'ADD', 'ADC', 'SUB', 'SBC', 'AND', 'OR', 'XOR'}
+
+# Instruction text emitted by cg_op16 after its first load of A, keyed
+# by (op1, op2, dd, ds1, ds2).  Filled in on first use.
+_OP16_TEXT = {}
+
 # Control Destinations
 # RET implies a return after the current expression or statement.
 # Control destinations >= CD_LABEL refer to locally generated labels.
@@ -29,6 +70,7 @@ CD_RET = 0
 CD_NEXT = 1
 CD_LABEL = 100
 
+@lru_cache(maxsize=1024)
 def starts_with_decimal_digit(t):
     return '0' <= t[0] <= '9'
 
@@ -47,100 +89,99 @@ def is_pair(node):
     return isinstance(node, Pair)
 
 
+def node_args(node, n):
+    # Returns the first n arguments of the form (OP ARG1 ARG2 ...).
+    args = []
+    p = node.cdr
+    for _ in range(n):
+        args.append(p.car)
+        p = p.cdr
+    return args
+
+
+# Numeric literals: 0x hex, 0o octal, 0b binary, leading-zero octal, and
+# decimal.  Each alternative captures its digits in one group; the group
+# number selects the base from _NUMBER_BASES.
+_NUMBER = re.compile(r'0[xX]([0-9a-fA-F]+)|0[oO]([0-7]+)|0[bB]([01]+)|(0[0-7]*)|([1-9][0-9]*)')
+_NUMBER_BASES = (None, 16, 8, 2, 8, 10)
+
+
+@lru_cache(maxsize=1024)
 def to_number(t):
-    if len(t) >= 1:
-        if t[0] == '0':
-            if len(t) >= 3:
-                if t[1] in ['x', 'X']:
-                    return int(t[2:], 16)
-                elif t[1] in ['o', 'O']:
-                    return int(t[2:], 8)
-                elif t[1] in ['b', 'B']:
-                    return int(t[2:], 2)
-            return int(t, 8)
-        elif '1' <= t[0] <= '9':
-            return int(t, 10)
-    else:
+    if len(t) < 1:
         raise ValueError("to_number called with empty token")
+    m = _NUMBER.fullmatch(t)
+    if m is None:
+        raise ValueError(f"Malformed number: {t}")
+    return int(m[m.lastindex], _NUMBER_BASES[m.lastindex])
+
+
+def reg_state(regs, start):
+    # Describes the tracked registers in regs relative to the values they
+    # held in start, so two states can be compared.  Each register maps to
+    # the register whose starting value it holds, its constant, None when
+    # unknown, or a number shared by the registers holding one new value.
+    starting = {id(v): r for r, v in start.items()}
+    held = {}
+    for v in regs.values():
+        held[id(v)] = held.get(id(v), 0) + 1
+    state = {}
+    groups = {}
+    for r in sorted(_REG8):
+        v = regs.get(r)
+        if (v is None) or isinstance(v, int):
+            state[r] = v
+        elif id(v) in starting:
+            state[r] = starting[id(v)]
+        elif held[id(v)] == 1:
+            state[r] = None
+        else:
+            state[r] = groups.setdefault(id(v), len(groups))
+    return state
 
 
 class Compiler:
+    __slots__ = ('parser_config', 'assembly_listing', '_emit', 'globals', 'next_label', '_regs')
+
     def __init__(self):
         self.parser_config = ParserConfig({}, dots_are_cons=True)
         self.assembly_listing = None
-        self.globals = list()
+        self._emit = None
+        self.globals = dict()
         self.next_label = CD_LABEL - 1
+        self._regs = dict()  # last known value of each 8-bit register
 
     def make_label(self):
         self.next_label = self.next_label + 1
         return self.next_label
 
     def main(self, script=None):
-        self.assembly_listing = []
+        self.assembly_listing = io.StringIO()
+        self._emit = self.assembly_listing.write
 
         tree = parse(script, self.parser_config)
         for node in tree:
             self.cg_form(node, DD_HL, CD_RET)
-        for line in self.assembly_listing:
-            print(line)
+        sys.stdout.write(self.assembly_listing.getvalue())
 
     def cg_form(self, node, dd, cd):
         if dd == DD_ZFLAG:
             self.cg_form(node, DD_HL, CD_NEXT)
-            self.asm(None, "LD", "A,L")
+            self.cg_ld8_r8("A", "L")
             self.asm(None, "OR", "A,H")
             self.cg_goto(cd)
         elif is_pair(node):
-            if node.car == '+':
-                self.cg_binop(self.cg_add, node, dd, cd)
-            elif node.car == '-':
-                self.cg_binop(self.cg_subtract, node, dd, cd)
-            elif node.car == '*':
-                self.cg_binop(self.cg_multiply, node, dd, cd)
-            elif node.car == '/':
-                self.cg_binop(self.cg_divide, node, dd, cd)
-            elif node.car == '&':
-                self.cg_binop(self.cg_bit_and, node, dd, cd)
-            elif node.car == '|':
-                self.cg_binop(self.cg_bit_or, node, dd, cd)
-            elif node.car == '^':
-                self.cg_binop(self.cg_bit_xor, node, dd, cd)
-            elif node.car == 'int16':
-                self.declare_variables(node)
-            elif node.car == 'set':
-                self.cg_set_var(node, dd, cd)
-            elif node.car == 'if':
-                self.cg_if(node, dd, cd)
-            elif node.car == 'sub':
-                self.cg_sub(node, dd, CD_RET)
-            elif node.car == 'do':
-                self.cg_statements(node.cdr, dd, CD_RET)
-            elif node.car == '@':
-                self.cg_address_of(node, dd, cd)
-            elif node.car == 'poke':
-                self.cg_poke(node, dd, cd)
-            elif node.car == 'peek':
-                self.cg_peek(node, dd, cd)
-            elif node.car == 'output': # Intel/Z80 specific
-                self.cg_output(node, dd, cd)
-            elif node.car == 'input': # Intel/Z80 specific
-                self.cg_input(node, dd, cd)
-            elif node.car == 'highbyte':
-                self.cg_highbyte(node, dd, cd)
-            elif node.car == 'lowbyte':
-                self.cg_lowbyte(node, dd, cd)
-            elif node.car == '>>':
-                self.cg_shift_right_logical(node, dd, cd)
-            elif node.car == '<<':
-                self.cg_shift_left(node, dd, cd)
+            if not isinstance(node.car, str):
+                raise ValueError(f"Unsupported: {node.car}")
+            handler = self._FORM_DISPATCH.get(node.car)
+            if handler is not None:
+                handler(self, node, dd, cd)
+            elif node.car not in self.globals:
+                raise ValueError(f"Unsupported: {node.car}")
+            elif node.cdr is not nil:
+                raise ValueError(f"Arguments to subroutines not supported: {node.car}")
             else:
-                if node.car not in self.globals:
-                    raise ValueError("Unsupported: {}".format(node.car))
-                else:
-                    if node.cdr is not nil:
-                        raise ValueError("Arguments to subroutines not supported: {}".format(node.car))
-                    else:
-                        self.cg_call_libfn(node.car, cd)
+                self.cg_call_libfn(node.car, cd)
         else:
             if starts_with_decimal_digit(node):
                 n = to_number(node)
@@ -149,7 +190,7 @@ class Compiler:
                     self.cg_ld16(dd, n)
                     self.cg_goto(cd)
                 else:
-                    raise ValueError("Unknown data destination: {}".format(dd))
+                    raise ValueError(f"Unknown data destination: {dd}")
             elif node[0] == '-':
                 n = -to_number(node[1:])
 
@@ -157,84 +198,98 @@ class Compiler:
                     self.cg_ld16(dd, n)
                     self.cg_goto(cd)
                 else:
-                    raise ValueError("Unknown data destination: {}".format(dd))
+                    raise ValueError(f"Unknown data destination: {dd}")
             else:
                 if node in self.globals:
                     self.cg_ld16_gv(dd, node)
                     self.cg_goto(cd)
                 else:
-                    raise ValueError("Symbol not declared: {}".format(node))
-
-    def cg_shift_right_logical(self, node, dd, cd):
-        # (>> EXPR COUNT)
-        e = node.cdr.car
-        cnt = node.cdr.cdr.car
-        
-        n_cnt = None
-        if starts_with_decimal_digit(cnt):
-            n_cnt = to_number(cnt)
+                    raise ValueError(f"Symbol not declared: {node}")
 
-        def do_variable_shift():
-            loopback = self.make_label()
-            skipahead = None
-
-            self.cg_form(cnt, DD_B, CD_NEXT)
-            if n_cnt is None:
-                skipahead = self.make_label()
-                self.asm(None, "LD", "A,B")
-                self.asm(None, "OR", "A,A")
-                self.asm(None, "JZ", "L{}".format(skipahead))
-            self.asm(loopback, "SRL", "H")
-            self.asm(None, "RL", "L")
-            self.asm(None, "DJNZ", "L{}".format(loopback))
-            if n_cnt is None:
-                self.cg_emit_label(skipahead)
+    def cg_shift(self, node, dd, cd):
+        # (<< EXPR COUNT) or (>> EXPR COUNT)
+        # Shifts EXPR in HL.  A variable COUNT loops on B, skipping the loop
+        # when it is zero.  The loop body is a few bytes, so DJNZ always
+        # reaches it.
+        shift = _SHIFTS[node.car]
+        e, cnt = node_args(node, 2)
 
         self.cg_form(e, DD_HL, CD_NEXT)
-        if n_cnt is None:
-            do_variable_shift()
-        elif n_cnt > 4:
-            do_variable_shift()
-        else: # 0 <= n_cnt <= 4:
-            for x in range(n_cnt):
-                self.asm(None, "SRL", "H")
-                self.asm(None, "RL", "L")
+        if starts_with_decimal_digit(cnt):
+            self._cg_shift_hl_by(to_number(cnt), dd, cd, shift)
+            return
+
+        loopback = self.make_label()
+        skipahead = self.make_label()
+        self.cg_form(cnt, DD_B, CD_NEXT)
+        self.cg_ld8_r8("A", "B")
+        self.asm(None, "OR", "A,A")
+        self.asm(None, "JR", f"Z,L{skipahead}")
+        self._cg_shift_loop(loopback, shift[0])
+        self.cg_emit_label(skipahead)
+        if dd != DD_HL:
+            self.cg_ld16_r16(dd, DD_HL)
         self.cg_goto(cd)
 
-    def cg_shift_left(self, node, dd, cd):
+    def _cg_shift_hl_by(self, n, dd, cd, shift):
+        # Shifts HL by the constant n.  Counts up to max_unrolled are
+        # unrolled; larger ones loop on B.
+        step, max_unrolled, to_r8, from_r8, byte_step = shift
+        if n >= 16:
+            self.cg_ld16(DD_HL, 0)
+            n = 0
+        elif n >= 8:
+            self.cg_ld8_r8(to_r8, from_r8)
+            self.cg_ld_zero(from_r8)
+            n = n - 8
+            step = byte_step
+
+        if n > max_unrolled:
+            loopback = self.make_label()
+            self.cg_ld16(DD_B, n)
+            self._cg_shift_loop(loopback, step)
+        else:
+            for x in range(n):
+                for mnem, oper in step:
+                    self.asm(None, mnem, oper)
+        if dd != DD_HL:
+            self.cg_ld16_r16(dd, DD_HL)
         self.cg_goto(cd)
 
+    def _cg_shift_loop(self, loopback, step):
+        self.cg_emit_label(loopback)
+        for mnem, oper in step:
+            self.asm(None, mnem, oper)
+        self.asm(None, "DJNZ", f"L{loopback}")
+
     def cg_highbyte(self, node, dd, cd):
         self.cg_form(node.cdr.car, DD_HL, CD_NEXT)
-        self.asm(None, "LD", "L,H")
-        self.asm(None, "LD", "H,0")
+        self.cg_ld8_r8("L", "H")
+        self.cg_ld_zero('H')
         self.cg_goto(cd)
 
     def cg_lowbyte(self, node, dd, cd):
         self.cg_form(node.cdr.car, DD_HL, CD_NEXT)
-        self.asm(None, "LD", "H,0")
+        self.cg_ld_zero('H')
         self.cg_goto(cd)
 
     def cg_input(self, node, dd, cd):
         # (input SIZE ADDR)
-        sz = node.cdr.car
-        addr = node.cdr.cdr.car
+        sz, addr = node_args(node, 2)
 
         if sz == 'byte':
-            dst = self.to_reg(dd)
             self.cg_form(addr, DD_BC, CD_NEXT)
             if dd == DD_A:
                 self.asm(None, "IN", "A,(C)")
             else:
                 self.asm(None, "IN", "A,(C)")
-                self.asm(None, "LD", "{},A".format(dst[1]))
-                self.asm(None, "LD", "{},0".format(dst[0]))
+                self.cg_ld8_r8(_REG_LO[dd], "A")
+                self.cg_ld_zero(_REG_HI[dd])
         elif sz == 'word':
-            dst = self.to_reg(dd)
             if dd == DD_BC:
                 self.cg_input(node, DD_HL, CD_NEXT)
-                self.asm(None, "LD", "B,H")
-                self.asm(None, "LD", "C,L")
+                self.cg_ld8_r8("B", "H")
+                self.cg_ld8_r8("C", "L")
                 self.cg_goto(cd)
             else:
                 self.cg_form(addr, DD_BC, CD_NEXT)
@@ -242,20 +297,18 @@ class Compiler:
                 self.asm(None, "IN", "A,(C)")
             else:
                 self.asm(None, "IN", "A,(C)")
-                self.asm(None, "LD", "{},A".format(dst[1]))
+                self.cg_ld8_r8(_REG_LO[dd], "A")
                 self.asm(None, "INC", "BC")
                 self.asm(None, "IN", "A,(C)")
-                self.asm(None, "LD", "{},A".format(dst[0]))
+                self.cg_ld8_r8(_REG_HI[dd], "A")
         else:
-            raise ValueError("Unsupported poke size: {}".format(sz))
+            raise ValueError(f"Unsupported poke size: {sz}")
 
         self.cg_goto(cd)
 
     def cg_output(self, node, dd, cd):
         # (output SIZE ADDR DATUM)
-        sz = node.cdr.car
-        addr = node.cdr.cdr.car
-        datum = node.cdr.cdr.cdr.car
+        sz, addr, datum = node_args(node, 3)
 
         if sz == 'byte':
             self.cg_form(addr, DD_BC, CD_NEXT)
@@ -271,30 +324,27 @@ class Compiler:
                 self.cg_push_hl()
                 self.cg_form(addr, DD_BC, CD_NEXT)
                 self.cg_pop_de()
-            self.asm(None, "LD", "A,E")
+            self.cg_ld8_r8("A", "E")
             self.asm(None, "OUT", "(C),A")
             self.asm(None, "INC", "BC")
-            self.asm(None, "LD", "A,D")
+            self.cg_ld8_r8("A", "D")
             self.asm(None, "OUT", "(C),A")
             self.cg_goto(cd)
         else:
-            raise ValueError("Unsupported poke size: {}".format(sz))
+            raise ValueError(f"Unsupported poke size: {sz}")
 
     def cg_peek(self, node, dd, cd):
         # (peek SIZE ADDR)
-        sz = node.cdr.car
-        addr = node.cdr.cdr.car
+        sz, addr = node_args(node, 2)
 
         if sz == 'byte':
-            dst = self.to_reg(dd)
             self.cg_form(addr, DD_HL, CD_NEXT)
             if dd == DD_A:
                 self.asm(None, "LD", "A,(HL)")
             else:
-                self.asm(None, "LD", "{},(HL)".format(dst[1]))
-                self.asm(None, "LD", "{},0".format(dst[0]))
+                self.asm(None, "LD", f"{_REG_LO[dd]},(HL)")
+                self.cg_ld_zero(_REG_HI[dd])
         elif sz == 'word':
-            dst = self.to_reg(dd)
             if dd == DD_HL:
                 src = "DE"
                 self.cg_form(addr, DD_DE, CD_NEXT)
@@ -302,21 +352,19 @@ class Compiler:
                 src = "HL"
                 self.cg_form(addr, DD_HL, CD_NEXT)
             if dd == DD_A:  # we're reading a word, but something else is truncating it to a byte.
-                self.asm(None, "LD", "A,({})".format(src))
+                self.asm(None, "LD", f"A,({src})")
             else:
-                self.asm(None, "LD", "{},({})".format(dst[1], src))
+                self.asm(None, "LD", f"{_REG_LO[dd]},({src})")
                 self.asm(None, "INC", src)
-                self.asm(None, "LD", "{},({})".format(dst[0], src))
+                self.asm(None, "LD", f"{_REG_HI[dd]},({src})")
         else:
-            raise ValueError("Unsupported poke size: {}".format(sz))
+            raise ValueError(f"Unsupported poke size: {sz}")
 
         self.cg_goto(cd)
 
     def cg_poke(self, node, dd, cd):
         # (poke SIZE ADDR DATUM)
-        sz = node.cdr.car
-        addr = node.cdr.cdr.car
-        datum = node.cdr.cdr.cdr.car
+        sz, addr, datum = node_args(node, 3)
 
         if sz == 'byte':
             self.cg_form(addr, DD_HL, CD_NEXT)
@@ -332,15 +380,15 @@ class Compiler:
                 self.cg_push_hl()
                 self.cg_form(addr, DD_HL, CD_NEXT)
                 self.cg_pop_de()
-            self.asm(None, "LD", "A,E")
+            self.cg_ld8_r8("A", "E")
             self.asm(None, "LD", "(HL),A")
             self.asm(None, "INC", "HL")
-            self.asm(None, "LD", "A,D")
+            self.cg_ld8_r8("A", "D")
             self.asm(None, "LD", "(HL),A")
             # self.asm(None, "DEC", "HL")  # Leave HL undefined??
             self.cg_goto(cd)
         else:
-            raise ValueError("Unsupported poke size: {}".format(sz))
+            raise ValueError(f"Unsupported poke size: {sz}")
 
     def cg_address_of(self, node, dd, cd):
         # (@ VAR)
@@ -348,7 +396,7 @@ class Compiler:
         if v is nil:
             raise ValueError("@ operator missing variable or procedure name")
         elif v.car not in self.globals:
-            raise ValueError("@ operator reference to undeclared variable or procedure: {}".format(v.car))
+            raise ValueError(f"@ operator reference to undeclared variable or procedure: {v.car}")
         else:
             self.cg_ld16(dd, v.car)
             self.cg_goto(cd)
@@ -373,8 +421,8 @@ class Compiler:
         name = node.cdr.car
         statements = node.cdr.cdr
         if name in self.globals:
-            raise ValueError("Symbol already defined: {}".format(name))
-        self.globals.append(name)
+            raise ValueError(f"Symbol already defined: {name}")
+        self.globals[name] = None
         self.cg_emit_label(name)
         self.cg_statements(statements, dd, cd)
 
@@ -383,8 +431,7 @@ class Compiler:
         label_false = self.make_label()
         label_end = self.make_label()
 
-        pred = node.cdr.car
-        conseq = node.cdr.cdr.car
+        pred, conseq = node_args(node, 2)
         alter = None
         if node.cdr.cdr.cdr is not nil:
             alter = node.cdr.cdr.cdr.car
@@ -398,73 +445,149 @@ class Compiler:
             else:
                 self.cg_form(pred, DD_ZFLAG, (CD_NEXT, cd))
                 self.cg_form(conseq, DD_HL, cd)
-        else:
+        elif (cd == CD_NEXT) or isinstance(cd, tuple):
             self.cg_form(pred, DD_ZFLAG, (CD_NEXT, label_false))
             self.cg_form(conseq, DD_HL, label_end)
             self.cg_emit_label(label_false)
             self.cg_form(alter, DD_HL, CD_NEXT)
             self.cg_emit_label(label_end)
             self.cg_goto(cd)
+        else:
+            # Both arms go straight to cd, so neither jumps to a return or
+            # to another jump.
+            self.cg_form(pred, DD_ZFLAG, (CD_NEXT, label_false))
+            self.cg_form(conseq, DD_HL, cd)
+            self.cg_emit_label(label_false)
+            self.cg_form(alter, DD_HL, cd)
 
     def declare_variables(self, node):
         varlist = node.cdr
         while varlist is not nil:
             if varlist.car in self.globals:
-                raise ValueError("Variable already defined: {}".format(varlist.car))
-            self.globals.append(varlist.car)
+                raise ValueError(f"Variable already defined: {varlist.car}")
+            self.globals[varlist.car] = None
             self.asm(varlist.car, "DEFW", "0")
             varlist = varlist.cdr
 
     def cg_set_var(self, node, dd, cd):
         # (set VAR EXPR_hl)
-        v = node.cdr.car
-        e = node.cdr.cdr.car
+        v, e = node_args(node, 2)
 
         self.cg_form(e, DD_HL, CD_NEXT)
-        self.asm(None, "LD", "({}),HL".format(v))
-        self.cg_ld16_r16(dd, DD_HL)
+        self.asm(None, "LD", f"({v}),HL")
+        if dd != DD_HL:
+            self.cg_ld16_r16(dd, DD_HL)
         self.cg_goto(cd)
 
-    def cg_binop(self, op, node, dd, cd):
-        if is_pair(node.cdr.car):
-            self.cg_form(node.cdr.cdr.car, DD_HL, CD_NEXT)
+    def cg_binop(self, node, dd, cd):
+        op = self._BINOPS[node.car]
+        lhs, rhs = node_args(node, 2)
+        if (not is_pair(rhs)) and starts_with_decimal_digit(rhs):
+            n = to_number(rhs)
+            if (n == 0) and (op is Compiler.cg_multiply) and (not is_pair(lhs)) and ((lhs in self.globals) or starts_with_decimal_digit(lhs)):
+                self.cg_ld16(dd, 0)
+                self.cg_goto(cd)
+                return
+            shift = self.cg_binop_constant(op, n)
+            if shift == 0:
+                self.cg_form(lhs, dd, cd)
+                return
+            elif shift is not None:
+                self.cg_form(lhs, DD_HL, CD_NEXT)
+                self._cg_shift_hl_by(shift, dd, cd, _SHIFTS['<<'])
+                return
+            if is_pair(lhs):
+                # Loading a constant into DE leaves HL alone, so no need to
+                # save LHS on the stack.  Any other RHS must be evaluated
+                # first, as LHS may have side effects on it.
+                self.cg_form(lhs, DD_HL, CD_NEXT)
+                self.cg_form(rhs, DD_DE, CD_NEXT)
+                op(self, dd, DD_HL, DD_DE, cd)
+                return
+        if is_pair(lhs):
+            self.cg_form(rhs, DD_HL, CD_NEXT)
             self.cg_push_hl()
-            self.cg_form(node.cdr.car, DD_HL, CD_NEXT)
+            self.cg_form(lhs, DD_HL, CD_NEXT)
             self.cg_pop_de()
         else:
-            self.cg_form(node.cdr.cdr.car, DD_DE, CD_NEXT)
-            self.cg_form(node.cdr.car, DD_HL, CD_NEXT)
-        op(dd, DD_HL, DD_DE, cd)
+            self.cg_form(rhs, DD_DE, CD_NEXT)
+            self.cg_form(lhs, DD_HL, CD_NEXT)
+        op(self, dd, DD_HL, DD_DE, cd)
+
+    def cg_binop_constant(self, op, n):
+        # Algebraic simplification and strength reduction for (OP E N).
+        # Returns how far left to shift E for the same result, with 0 when
+        # (OP E N) is just E, or None when the general binop code is still
+        # needed.  Division is signed, so it is never reduced to a logical
+        # shift.
+        if (n == 0) and (op in [Compiler.cg_add, Compiler.cg_subtract, Compiler.cg_bit_or, Compiler.cg_bit_xor]):
+            return 0
+        elif (n == 1) and (op in [Compiler.cg_multiply, Compiler.cg_divide]):
+            return 0
+        elif (op is Compiler.cg_multiply) and (2 <= n <= 256) and ((n & (n - 1)) == 0):
+            return n.bit_length() - 1
+        return None
 
     def cg_ld16_gv(self, dd, t):
         if dd == DD_B:
             self.cg_ld16_gv(DD_A, t)
-            self.asm(None, "LD", "B,A")
+            self.cg_ld8_r8("B", "A")
         else:
-            self.asm(None, "LD", "{},({})".format(self.to_reg(dd), t))
+            self.asm(None, "LD", f"{_REG[dd]},({t})")
 
     def cg_op16(self, dd, ds1, ds2, cd, op1, op2):
-        self.asm(None, "LD", "A,{}".format(self.to_reg(ds1)[1]))
-        self.asm(None, op1, "A,{}".format(self.to_reg(ds2)[1]))
-        if dd != DD_A:
-            self.asm(None, "LD", "{},A".format(self.to_reg(dd)[1]))
-            self.asm(None, "LD", "A,{}".format(self.to_reg(ds1)[0]))
-            self.asm(None, op2, "A,{}".format(self.to_reg(ds2)[0]))
-            self.asm(None, "LD", "{},A".format(self.to_reg(dd)[0]))
+        self.cg_ld8_r8("A", _REG_LO[ds1])
+        key = (op1, op2, dd, ds1, ds2)
+        text = _OP16_TEXT.get(key)
+        if text is None:
+            ops = [(op1, f"A,{_REG_LO[ds2]}")]
+            if dd != DD_A:
+                ops.extend([
+                    ("LD", f"{_REG_LO[dd]},A"),
+                    ("LD", f"A,{_REG_HI[ds1]}"),
+                    (op2, f"A,{_REG_HI[ds2]}"),
+                    ("LD", f"{_REG_HI[dd]},A"),
+                ])
+            text = "".join(f"    {mnem:<6} {oper}\n" for mnem, oper in ops)
+            self.check_op16_regs(ops, dd)
+            _OP16_TEXT[key] = text
+        self._emit(text)
+        self.op16_regs(dd)
         self.cg_goto(cd)
 
-    def cg_add(self, dd, ds1, ds2, cd):
-        def do_add(d, a, b):
-            if (d == DD_HL) and (a == DD_HL):
-                self.asm(None, "ADD", "HL,{}".format(self.to_reg(b)))
-            else:
-                self.cg_op16(dd, ds1, ds2, cd, "ADD", "ADC")
+    def op16_regs(self, dd):
+        # Updates self._regs as track_regs would for the instructions
+        # cg_op16 emits after its first load of A, without decoding them
+        # one at a time.  check_op16_regs keeps the two in step.
+        if dd != DD_A:
+            hi = object()
+            self._regs[_REG_LO[dd]] = object()
+            self._regs[_REG_HI[dd]] = hi
+            self._regs['A'] = hi
+        else:
+            self._regs.pop('A', None)
+
+    def check_op16_regs(self, ops, dd):
+        # Runs track_regs and op16_regs from the same scratch register
+        # state and checks they agree.  Runs once per cached sequence.
+        start = {r: object() for r in _REG8}
+        saved = self._regs
+        self._regs = dict(start)
+        for mnem, oper in ops:
+            self.track_regs(mnem, oper)
+        tracked = self._regs
+        self._regs = dict(start)
+        self.op16_regs(dd)
+        shortcut, self._regs = self._regs, saved
+        assert reg_state(tracked, start) == reg_state(shortcut, start), f"op16_regs disagrees with track_regs for {ops}"
 
-        if (dd == DD_HL) and (ds2 == DD_HL):
-            do_add(dd, ds2, ds1)
+    def cg_add(self, dd, ds1, ds2, cd):
+        if (dd == DD_HL) and (DD_HL in [ds1, ds2]):
+            other = ds2 if ds1 == DD_HL else ds1
+            self.asm(None, "ADD", f"HL,{_REG[other]}")
+            self.cg_goto(cd)
         else:
-            do_add(dd, ds1, ds2)
-        self.cg_goto(cd)
+            self.cg_op16(dd, ds1, ds2, cd, "ADD", "ADC")
 
     def cg_bit_and(self, dd, ds1, ds2, cd):
         self.cg_op16(dd, ds1, ds2, cd, 'AND', 'AND')
@@ -479,12 +602,14 @@ class Compiler:
         self.cg_op16(dd, ds1, ds2, cd, 'SUB', 'SBC')
 
     def cg_divide(self, dd, ds1, ds2, cd):
-        self.cg_call_libfn("divide_{}_{}".format(self.to_reg(ds1), self.to_reg(ds2)), cd)
-        self.cg_ld16_r16(dd, DD_HL)
+        self.cg_call_libfn(f"divide_{_REG[ds1]}_{_REG[ds2]}", cd)
+        if dd != DD_HL:
+            self.cg_ld16_r16(dd, DD_HL)
 
     def cg_multiply(self, dd, ds1, ds2, cd):
-        self.cg_call_libfn("multiply_{}_{}".format(self.to_reg(ds1), self.to_reg(ds2)), cd)
-        self.cg_ld16_r16(dd, DD_HL)
+        self.cg_call_libfn(f"multiply_{_REG[ds1]}_{_REG[ds2]}", cd)
+        if dd != DD_HL:
+            self.cg_ld16_r16(dd, DD_HL)
 
     def cg_call_libfn(self, fn_name, cd):
         if cd != CD_RET:
@@ -494,26 +619,45 @@ class Compiler:
             self.asm(None, "JP", fn_name)
 
     def cg_op_pair(self, op1, op2, dd, ds):
-        src = self.to_reg(ds)
-        dst = self.to_reg(dd)
-        self.asm(None, op1, "{},{}".format(dst[1], src[1]))
-        self.asm(None, op2, "{},{}".format(dst[0], src[0]))
+        self.asm(None, op1, f"{_REG_LO[dd]},{_REG_LO[ds]}")
+        self.asm(None, op2, f"{_REG_HI[dd]},{_REG_HI[ds]}")
 
     def cg_ld16(self, dd, n):
-        self.asm(None, "LD", "{},{}".format(self.to_reg(dd), n))
+        if (n == 0) and (dd in [DD_A, DD_B]):
+            self.cg_ld_zero(_REG[dd])
+        else:
+            self.asm(None, "LD", f"{_REG[dd]},{n}")
+
+    def cg_ld_zero(self, r8):
+        # XOR A is shorter and faster than LD A,0, but for any other
+        # register it only pays off when A is already known to be zero.
+        # Nothing is emitted if the register already holds zero.
+        # Flags are never live across a zero load, so XOR A is safe here.
+        if r8 == 'A':
+            if self._regs.get('A') != 0:
+                self.asm(None, "XOR", "A")
+        elif self._regs.get('A') == 0:
+            self.cg_ld8_r8(r8, 'A')
+        elif self._regs.get(r8) != 0:
+            self.asm(None, "LD", f"{r8},0")
 
     def cg_ld16_r16(self, dd, ds):
         if ds == dd:
             return
         if dd != DD_A:
-            self.cg_op_pair("LD", "LD", dd, ds)
+            self.cg_ld8_r8(_REG_LO[dd], _REG_LO[ds])
+            self.cg_ld8_r8(_REG_HI[dd], _REG_HI[ds])
         else:
-            self.asm(None, "LD", "A,{}".format(self.to_reg(ds)[1]))
+            self.cg_ld8_r8("A", _REG_LO[ds])
 
     def cg_ld8_r8(self, rd, rs):
-        self.asm(None, "LD", "{},{}".format(rd, rs))
+        v = self._regs.get(rs)
+        if (v is None) or (self._regs.get(rd) != v):
+            self.asm(None, "LD", f"{rd},{rs}")
 
     def cg_goto(self, cd):
+        if cd == CD_NEXT:
+            return
         if isinstance(cd, tuple):
             true_branch = cd[0]
             false_branch = cd[1]
@@ -524,7 +668,7 @@ class Compiler:
                 elif false_branch == CD_RET:
                     self.asm(None, "RET", "Z")
                 else:
-                    self.asm(None, "JP", "Z,L{}".format(false_branch))
+                    self.asm(None, "JP", f"Z,L{false_branch}")
             elif true_branch == CD_RET:
                 if false_branch == CD_NEXT:
                     self.asm(None, "RET", "NZ")
@@ -533,14 +677,12 @@ class Compiler:
                 else:
                     self.asm(None, "RET", "NZ")
                     self.cg_goto(false_branch)
-        elif cd == CD_NEXT:
-            pass
         elif cd == CD_RET:
             self.asm(None, "RET", None)
         elif cd >= CD_LABEL:
-            self.asm(None, "JP", "L{}".format(cd))
+            self.asm(None, "JP", f"L{cd}")
         else:
-            raise ValueError("Unknown control destination: {}".format(cd))
+            raise ValueError(f"Unknown control destination: {cd}")
 
     def cg_push_hl(self):
         self.asm(None, "PUSH", "HL")
@@ -554,23 +696,83 @@ class Compiler:
     def cg_emit_label(self, l):
         if l is not None:
             if isinstance(l, int):
-                l = "L{}".format(l)
-            self.assembly_listing.append("{}:".format(l))
+                l = f"L{l}"
+            self._emit(f"{l}:\n")
+            self._regs.clear()
 
     def asm(self, label, mnem, oper):
-        self.cg_emit_label(label)
+        if label is not None:
+            self.cg_emit_label(label)
         if oper is None:
             oper = ""
-        self.assembly_listing.append("    {:6} {}".format(mnem, oper))
-
-    def to_reg(self, dd):
-        return {
-            DD_A:  'A',
-            DD_B:  'B',
-            DD_BC: 'BC',
-            DD_DE: 'DE',
-            DD_HL: 'HL',
-        }[dd]
+        self._emit(f"    {mnem:<6} {oper}\n")
+        self.track_regs(mnem, oper)
+
+    def track_regs(self, mnem, oper):
+        # Keep self._regs in step with the instruction just emitted.
+        # Registers holding the same value share the same object; known
+        # constants are held as ints.  Anything we don't model forgets
+        # everything.
+        regs = self._regs
+        if mnem == "LD":
+            dst, _, src = oper.partition(",")
+            if dst in _REG8:
+                if src in _REG8:
+                    if src not in regs:
+                        regs[src] = object()
+                    regs[dst] = regs[src]
+                elif src.lstrip("-").isdigit():
+                    regs[dst] = int(src)
+                else:
+                    regs.pop(dst, None)
+            elif dst in _REG16:
+                regs.pop(dst[0], None)
+                regs.pop(dst[1], None)
+        elif (mnem == "XOR") and (oper == "A"):
+            regs['A'] = 0
+        elif (mnem in _ALU8) and oper.startswith("A,"):
+            regs.pop('A', None)
+        elif mnem not in ["OUT", "PUSH"]:
+            regs.clear()
+
+
+# Special forms recognized by cg_form, keyed by the symbol in operator
+# position.  Anything not listed here is treated as a subroutine call.
+Compiler._FORM_DISPATCH = {
+    '+':        Compiler.cg_binop,
+    '-':        Compiler.cg_binop,
+    '*':        Compiler.cg_binop,
+    '/':        Compiler.cg_binop,
+    '&':        Compiler.cg_binop,
+    '|':        Compiler.cg_binop,
+    '^':        Compiler.cg_binop,
+    'int16':    lambda self, node, dd, cd: self.declare_variables(node),
+    'set':      Compiler.cg_set_var,
+    'if':       Compiler.cg_if,
+    'sub':      lambda self, node, dd, cd: self.cg_sub(node, dd, CD_RET),
+    'do':       lambda self, node, dd, cd: self.cg_statements(node.cdr, dd, CD_RET),
+    '@':        Compiler.cg_address_of,
+    'poke':     Compiler.cg_poke,
+    'peek':     Compiler.cg_peek,
+    'output':   Compiler.cg_output,  # Intel/Z80 specific
+    'input':    Compiler.cg_input,  # Intel/Z80 specific
+    'highbyte': Compiler.cg_highbyte,
+    'lowbyte':  Compiler.cg_lowbyte,
+    '>>':       Compiler.cg_shift,
+    '<<':       Compiler.cg_shift,
+}
+
+# Binary operators handled by cg_binop, keyed by symbol.  Each emitter
+# takes (dd, ds1, ds2, cd) once both operands are in registers.
+Compiler._BINOPS = {
+    '+': Compiler.cg_add,
+    '-': Compiler.cg_subtract,
+    '*': Compiler.cg_multiply,
+    '/': Compiler.cg_divide,
+    '&': Compiler.cg_bit_and,
+    '|': Compiler.cg_bit_or,
+    '^': Compiler.cg_bit_xor,
+}
 
 
 if __name__ == '__main__':